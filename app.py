@@ -1,15 +1,29 @@
 import os
+import sys
+import atexit
+import signal
 import time
 import json
 import logging
 import random
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
+try:
+    import orjson
+except ImportError:  # optional speedup, stdlib json works too
+    orjson = None
+
 import requests
+from requests.adapters import HTTPAdapter
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 
+# image picks don't need crypto-grade randomness; seed the default PRNG once from OS entropy
+random.seed()
+
 logging.basicConfig(
     level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format="%(asctime)s %(levelname)s %(message)s",
@@ -30,6 +44,17 @@ if not TOKEN or not CHAT_ID:
     raise RuntimeError("Missing env vars: TOKEN and CHAT_ID are required.")
 
 API_BASE = f"https://api.telegram.org/bot{TOKEN}"
+_URL_SEND_MESSAGE = f"{API_BASE}/sendMessage"
+_URL_SEND_PHOTO = f"{API_BASE}/sendPhoto"
+_URL_GET_UPDATES = f"{API_BASE}/getUpdates"
+
+# scheduler worker threads; each may hold a Telegram connection alongside the long-poll thread
+SCHEDULER_WORKERS = 4
+
+# one keep-alive session for all Telegram / config calls (avoid a TLS handshake per request)
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=SCHEDULER_WORKERS + 1, max_retries=0))
+SESSION.headers["Connection"] = "keep-alive"
 
 DEFAULT_CONFIG = {
     "timezone": "Asia/Ho_Chi_Minh",
@@ -39,89 +64,211 @@ DEFAULT_CONFIG = {
     "jitter_seconds_min": 0,
     "jitter_seconds_max": 0,
 
-    # images can be string or list of strings (file_id or https url)
-    "images": {"left": "", "right": ""},
+    # images can be string or list of strings (file_id or https url);
+    # fetch_config normalizes them to lists
+    "images": {"left": [], "right": []},
     "slot_image": {"11:00": "left", "15:00": "right", "22:00": "left"},
 
     # weekly schedule: mon..sun -> "11:00"/"15:00"/"22:00" -> [messages...]
     "weekly": {}
 }
 
-_cache = {"loaded_at": 0, "data": DEFAULT_CONFIG}
+_cache = {"loaded_at": 0, "data": DEFAULT_CONFIG, "etag": "", "body": b"", "unchanged_streak": 0, "retry_at": 0}
+
+# refresh interval doubles after each unchanged fetch, up to this cap
+CONFIG_MAX_REFRESH_SECONDS = 3600
+# after a failed refresh, serve the cached config for this long before trying again
+CONFIG_RETRY_SECONDS = 60
+_CACHE_LOCK = threading.Lock()
 
 STATE_FILE = "state.json"
+_STATE_TMP = STATE_FILE + ".tmp"
 _state = {"rr_index": 0, "last_day": ""}
+_state_dirty = False
+_state_last_flush = 0.0
+_state_flush_timer = None
+STATE_FLUSH_SECONDS = 1.0
+# guards _state: scheduler jobs and /test commands run on different worker threads
+_STATE_LOCK = threading.Lock()
+
+
+def _loads(raw: bytes):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
 
 
 def load_state():
     global _state
     try:
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            _state = json.load(f)
+        with open(STATE_FILE, "rb") as f:
+            loaded = _loads(f.read())
     except Exception:
-        _state = {"rr_index": 0, "last_day": ""}
+        loaded = {"rr_index": 0, "last_day": ""}
+    with _STATE_LOCK:
+        _state = loaded
 
 
 def save_state():
+    # write to a temp file then rename, so a crash never leaves a torn state.json
     try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(_state, f, ensure_ascii=False)
+        with open(_STATE_TMP, "wb") as f:
+            f.write(_dumps(_state))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(_STATE_TMP, STATE_FILE)
     except Exception as e:
         logging.warning("Failed to save state: %s", e)
 
 
-def fetch_config() -> dict:
-    global _cache
+def flush_state(force: bool = False):
+    # debounced save: coalesce rapid updates (e.g. a /test burst) into one write.
+    # caller must hold _STATE_LOCK
+    global _state_dirty, _state_last_flush, _state_flush_timer
+    if not _state_dirty:
+        return
     now = time.time()
-    data = _cache["data"]
-    refresh = int(data.get("refresh_seconds", DEFAULT_CONFIG["refresh_seconds"]))
+    if not force and now - _state_last_flush < STATE_FLUSH_SECONDS:
+        # deferred: make sure a trailing write still happens
+        if _state_flush_timer is None:
+            _state_flush_timer = threading.Timer(STATE_FLUSH_SECONDS, _flush_state_deferred)
+            _state_flush_timer.daemon = True
+            _state_flush_timer.start()
+        return
+    save_state()
+    _state_last_flush = now
+    _state_dirty = False
+
+
+def _flush_state_deferred():
+    global _state_flush_timer
+    with _STATE_LOCK:
+        _state_flush_timer = None
+        flush_state(force=True)
+
+
+def _flush_state_on_exit():
+    with _STATE_LOCK:
+        flush_state(force=True)
+
 
+atexit.register(_flush_state_on_exit)
+
+
+def _effective_refresh(cache: dict) -> int:
+    refresh = int(cache["data"].get("refresh_seconds", DEFAULT_CONFIG["refresh_seconds"]))
+    streak = cache["unchanged_streak"]
+    return max(refresh, min(refresh * (2 ** streak), CONFIG_MAX_REFRESH_SECONDS))
+
+
+def _config_is_fresh(now: float) -> bool:
+    return now - _cache["loaded_at"] < _effective_refresh(_cache) or now < _cache["retry_at"]
+
+
+def fetch_config() -> dict:
+    global _cache
     if not CONFIG_URL:
-        return data
+        return _cache["data"]
 
-    if now - _cache["loaded_at"] < refresh:
-        return data
+    if _config_is_fresh(time.time()):
+        return _cache["data"]
 
-    try:
-        r = requests.get(CONFIG_URL, timeout=15)
-        r.raise_for_status()
-        cfg = r.json() or {}
+    # single-flight: one thread refreshes, concurrent callers wait and reuse its result
+    with _CACHE_LOCK:
+        now = time.time()
+        if _config_is_fresh(now):
+            return _cache["data"]
 
-        merged = DEFAULT_CONFIG.copy()
-        merged.update(cfg)
+        data = _cache["data"]
+        streak = _cache["unchanged_streak"]
+        try:
+            # conditional GET: unchanged config comes back as an empty 304
+            headers = {"If-None-Match": _cache["etag"]} if _cache.get("etag") else {}
+            r = SESSION.get(CONFIG_URL, timeout=15, headers=headers)
+            if r.status_code == 304:
+                _cache["loaded_at"] = now
+                _cache["unchanged_streak"] = min(streak + 1, 16)
+                return data
+            r.raise_for_status()
 
-        # deep merge keys we care about
-        merged["images"] = {**DEFAULT_CONFIG["images"], **(cfg.get("images") or {})}
-        merged["slot_image"] = {**DEFAULT_CONFIG["slot_image"], **(cfg.get("slot_image") or {})}
-        merged["weekly"] = cfg.get("weekly") or {}
+            # config is a few KB, so compare the raw body instead of hashing it
+            if r.content == _cache["body"]:
+                _cache["loaded_at"] = now
+                _cache["unchanged_streak"] = min(streak + 1, 16)
+                return data
+            cfg = _loads(r.content) or {}
+
+            merged = DEFAULT_CONFIG.copy()
+            merged.update(cfg)
+
+            # deep merge keys we care about
+            images = {**DEFAULT_CONFIG["images"], **(cfg.get("images") or {})}
+            merged["images"] = {k: _normalize_list(v) for k, v in images.items()}
+            merged["slot_image"] = {**DEFAULT_CONFIG["slot_image"], **(cfg.get("slot_image") or {})}
+            merged["weekly"] = cfg.get("weekly") or {}
+
+            _cache = {
+                "loaded_at": now,
+                "data": merged,
+                "etag": r.headers.get("ETag", ""),
+                "body": r.content,
+                "unchanged_streak": 0,
+                "retry_at": 0,
+            }
+            logging.info("Config refreshed from CONFIG_URL")
+            return merged
+        except Exception as e:
+            logging.warning("Config refresh failed, using cached config. err=%s", e)
+            _cache["retry_at"] = time.time() + CONFIG_RETRY_SECONDS
+            return data
 
-        _cache = {"loaded_at": now, "data": merged}
-        logging.info("Config refreshed from CONFIG_URL")
-        return merged
-    except Exception as e:
-        logging.warning("Config refresh failed, using cached config. err=%s", e)
-        return data
+
+def _retry_after(resp) -> int:
+    # Telegram puts the flood-wait in parameters.retry_after, some proxies only set the header
+    try:
+        retry_after = (_loads(resp.content).get("parameters") or {}).get("retry_after")
+    except Exception:
+        retry_after = None
+    if retry_after is None:
+        retry_after = resp.headers.get("Retry-After", 1)
+    try:
+        return max(1, int(retry_after))
+    except (TypeError, ValueError):
+        return 1
 
 
 def _post(url: str, payload: dict) -> bool:
     if DRY_RUN:
-        logging.info("[DRY_RUN] POST %s keys=%s", url, list(payload.keys()))
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("[DRY_RUN] POST %s keys=%s", url, list(payload.keys()))
         return True
 
     for attempt in range(1, 5):
+        delay = min(30, 2 ** attempt) + random.uniform(0, 1)
         try:
-            resp = requests.post(url, data=payload, timeout=20)
+            resp = SESSION.post(url, data=payload, timeout=20)
             if resp.status_code == 200:
                 return True
             logging.warning("HTTP %s: %s", resp.status_code, resp.text[:400])
+            if resp.status_code == 429:
+                delay = _retry_after(resp)
+            elif 400 <= resp.status_code < 500:
+                # bad request / forbidden / not found: retrying won't help
+                return False
         except Exception as e:
             logging.warning("Request error attempt=%s err=%s", attempt, e)
-        time.sleep(2 * attempt)
+        if attempt < 4:
+            time.sleep(delay)
     return False
 
 
 def send_text(text: str, chat_id: str | None = None) -> bool:
-    url = f"{API_BASE}/sendMessage"
     payload = {
         "chat_id": chat_id or CHAT_ID,
         "text": text,
@@ -129,16 +276,36 @@ def send_text(text: str, chat_id: str | None = None) -> bool:
     }
     if PARSE_MODE:
         payload["parse_mode"] = PARSE_MODE
-    return _post(url, payload)
+    return _post(_URL_SEND_MESSAGE, payload)
 
 
 def send_photo(photo_ref: str, chat_id: str | None = None) -> bool:
     if not photo_ref:
         logging.info("No photo configured, skip send_photo.")
         return True
-    url = f"{API_BASE}/sendPhoto"
     payload = {"chat_id": chat_id or CHAT_ID, "photo": photo_ref}
-    return _post(url, payload)
+    return _post(_URL_SEND_PHOTO, payload)
+
+
+# Telegram's limit for photo captions (sendMessage allows 4096)
+CAPTION_MAX_LEN = 1024
+
+
+def send_photo_with_caption(photo_ref: str, caption: str, chat_id: str | None = None) -> bool:
+    payload = {"chat_id": chat_id or CHAT_ID, "photo": photo_ref, "caption": caption}
+    if PARSE_MODE:
+        payload["parse_mode"] = PARSE_MODE
+    return _post(_URL_SEND_PHOTO, payload)
+
+
+_TZ_CACHE = {"name": "", "tz": None}
+
+
+def _tz(name: str) -> ZoneInfo:
+    # only build a new ZoneInfo when the configured timezone actually changes
+    if _TZ_CACHE["tz"] is None or _TZ_CACHE["name"] != name:
+        _TZ_CACHE.update(name=name, tz=ZoneInfo(name))
+    return _TZ_CACHE["tz"]
 
 
 def _weekday_key(dt: datetime) -> str:
@@ -158,7 +325,8 @@ def _normalize_list(x):
 
 
 def pick_weekly_message(cfg: dict, slot_hhmm: str) -> str:
-    tzinfo = ZoneInfo(cfg.get("timezone", TZ))
+    global _state_dirty
+    tzinfo = _tz(cfg.get("timezone", TZ))
     now = datetime.now(tzinfo)
     day_key = _weekday_key(now)
 
@@ -170,53 +338,59 @@ def pick_weekly_message(cfg: dict, slot_hhmm: str) -> str:
 
     # round-robin across all sends (global), so it keeps changing even if some day only has 1 message
     today_key = now.strftime("%Y-%m-%d")
-    if _state.get("last_day") != today_key:
-        _state["last_day"] = today_key
-        save_state()
-
-    idx = int(_state.get("rr_index", 0)) % len(candidates)
-    _state["rr_index"] = int(_state.get("rr_index", 0)) + 1
-    save_state()
+    with _STATE_LOCK:
+        if _state.get("last_day") != today_key:
+            _state["last_day"] = today_key
+
+        idx = int(_state.get("rr_index", 0)) % len(candidates)
+        _state["rr_index"] = int(_state.get("rr_index", 0)) + 1
+        _state_dirty = True
+        flush_state()
     return candidates[idx]
 
 
 def pick_image(cfg: dict, slot_hhmm: str) -> str:
-    slot_image_key = (cfg.get("slot_image") or {}).get(slot_hhmm, "")
-    img_val = (cfg.get("images") or {}).get(slot_image_key, "")
-    pool = _normalize_list(img_val)
+    pool = cfg["images"].get(cfg["slot_image"].get(slot_hhmm, ""), [])
+    n = len(pool)
+    if n and (n & (n - 1)) == 0:
+        # power-of-2 pool: a masked bit draw needs no rejection sampling
+        return pool[random.getrandbits(n.bit_length() - 1)]
     return random.choice(pool) if pool else ""
 
 
-def maybe_jitter(cfg: dict):
+def jitter_offset(cfg: dict) -> int:
     jmin = int(cfg.get("jitter_seconds_min", 0) or 0)
     jmax = int(cfg.get("jitter_seconds_max", 0) or 0)
     if jmax <= 0 or jmax < jmin:
-        return
-    delay = random.randint(jmin, jmax)
-    if delay > 0:
-        logging.info("Jitter delay %ss before send", delay)
-        time.sleep(delay)
+        return 0
+    # never fire before the slot time, matching the old sleep-only jitter
+    return max(0, random.randint(jmin, jmax))
 
 
 def send_slot(slot_hhmm: str, target_chat: str | None = None) -> tuple[bool, str]:
     cfg = fetch_config()
 
-    # jitter before sending
-    maybe_jitter(cfg)
-
     text = pick_weekly_message(cfg, slot_hhmm)
     if not text:
         return False, f"slot {slot_hhmm}: no text configured for today"
 
-    tzinfo = ZoneInfo(cfg.get("timezone", TZ))
-    now = datetime.now(tzinfo).strftime("%Y-%m-%d %H:%M:%S")
-    logging.info("Run slot=%s at %s TZ=%s", slot_hhmm, now, cfg.get("timezone", TZ))
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        tzinfo = _tz(cfg.get("timezone", TZ))
+        now = datetime.now(tzinfo).strftime("%Y-%m-%d %H:%M:%S")
+        logging.info("Run slot=%s at %s TZ=%s", slot_hhmm, now, cfg.get("timezone", TZ))
+
+    photo_ref = pick_image(cfg, slot_hhmm)
+    # Telegram counts caption length in UTF-16 code units; this over-counts markup, so it's conservative
+    if photo_ref and len(text.encode("utf-16-le")) // 2 <= CAPTION_MAX_LEN:
+        # one sendPhoto with caption instead of sendMessage + sendPhoto
+        if send_photo_with_caption(photo_ref, text, chat_id=target_chat):
+            return True, f"slot {slot_hhmm}: ok"
+        logging.warning("slot %s: sendPhoto with caption failed, falling back to text + photo", slot_hhmm)
 
     ok_text = send_text(text, chat_id=target_chat)
     if not ok_text:
         return False, f"slot {slot_hhmm}: send_text failed"
 
-    photo_ref = pick_image(cfg, slot_hhmm)
     ok_photo = send_photo(photo_ref, chat_id=target_chat)
     if not ok_photo:
         return False, f"slot {slot_hhmm}: send_photo failed"
@@ -226,9 +400,29 @@ def send_slot(slot_hhmm: str, target_chat: str | None = None) -> tuple[bool, str
 def scheduled_job(slot_hhmm: str):
     ok, summary = send_slot(slot_hhmm, target_chat=None)
     if ok:
-        logging.info(summary)
+        logging.info("%s", summary)
     else:
-        logging.error(summary)
+        logging.error("%s", summary)
+
+
+SLOTS = ("11:00", "15:00", "22:00")
+
+
+def slot_trigger(slot_hhmm: str, cfg: dict, tzinfo: ZoneInfo) -> CronTrigger:
+    # jitter is baked into the fire time, so no worker thread sleeps before sending
+    hour, minute = slot_hhmm.split(":")
+    fire = datetime(2000, 1, 1, int(hour), int(minute)) + timedelta(seconds=jitter_offset(cfg))
+    return CronTrigger(hour=fire.hour, minute=fire.minute, second=fire.second, timezone=tzinfo)
+
+
+def reschedule_slots(scheduler: BackgroundScheduler):
+    # runs at midnight: pick fresh jitter offsets for the day's slots
+    cfg = fetch_config()
+    tzinfo = _tz(cfg.get("timezone", TZ))
+    for slot in SLOTS:
+        trigger = slot_trigger(slot, cfg, tzinfo)
+        scheduler.reschedule_job(f"slot_{slot}", trigger=trigger)
+        logging.info("Slot %s rescheduled with trigger %s", slot, trigger)
 
 
 def self_check():
@@ -236,7 +430,7 @@ def self_check():
         logging.info("Self-check skipped.")
         return
     cfg = fetch_config()
-    tzinfo = ZoneInfo(cfg.get("timezone", TZ))
+    tzinfo = _tz(cfg.get("timezone", TZ))
     now = datetime.now(tzinfo).strftime("%Y-%m-%d %H:%M:%S")
     msg = (
         "✅ Bot online\n"
@@ -257,9 +451,15 @@ def is_admin_user(update: dict) -> bool:
         return False
 
 
+_SLOT_MAP = {"11": "11:00", "15": "15:00", "22": "22:00", "11:00": "11:00", "15:00": "15:00", "22:00": "22:00"}
+_USAGE = ("usage", "用法：/test 11 | /test 15 | /test 22 | /test me 11")
+
+
 def handle_command(text: str):
-    parts = (text or "").strip().split()
-    if not parts or parts[0] != "/test":
+    if not text or not text.startswith("/test"):
+        return None
+    parts = text.split(maxsplit=3)
+    if parts[0] != "/test":
         return None
 
     target = "channel"
@@ -270,39 +470,56 @@ def handle_command(text: str):
         target = "me"
         slot = parts[2]
     else:
-        return ("usage", "用法：/test 11 | /test 15 | /test 22 | /test me 11")
+        return _USAGE
 
-    slot_map = {"11": "11:00", "15": "15:00", "22": "22:00", "11:00": "11:00", "15:00": "15:00", "22:00": "22:00"}
-    slot_hhmm = slot_map.get(slot)
+    slot_hhmm = _SLOT_MAP.get(slot)
     if not slot_hhmm:
-        return ("usage", "用法：/test 11 | /test 15 | /test 22 | /test me 11")
+        return _USAGE
     return (target, slot_hhmm)
 
 
-def poll_commands():
+def run_command(target: str, slot_hhmm: str, reply_chat: str):
+    if target == "usage":
+        send_text(slot_hhmm, chat_id=reply_chat)
+        return
+
+    if target == "me":
+        ok, summary = send_slot(slot_hhmm, target_chat=ADMIN_CHAT_ID or reply_chat)
+        send_text(("✅ " if ok else "❌ ") + summary, chat_id=ADMIN_CHAT_ID or reply_chat)
+    else:
+        ok, summary = send_slot(slot_hhmm, target_chat=None)
+        if ADMIN_CHAT_ID:
+            send_text(("✅ " if ok else "❌ ") + summary, chat_id=ADMIN_CHAT_ID)
+
+
+def poll_commands(scheduler: BackgroundScheduler):
     if not ENABLE_COMMANDS:
         logging.info("Command polling disabled.")
         return
 
     offset = 0
-    url = f"{API_BASE}/getUpdates"
     logging.info("Command polling started.")
 
     while True:
         try:
-            params = {"timeout": 30, "offset": offset}
-            r = requests.get(url, params=params, timeout=40)
+            params = {
+                "timeout": 50,
+                "offset": offset,
+                "limit": 10,
+                "allowed_updates": json.dumps(["message"]),  # only what handle_command uses
+            }
+            r = SESSION.get(_URL_GET_UPDATES, params=params, timeout=60)
             r.raise_for_status()
-            data = r.json()
+            data = _loads(r.content)
             if not data.get("ok"):
                 time.sleep(2)
                 continue
 
             for upd in data.get("result", []):
                 offset = upd["update_id"] + 1
-                msg = upd.get("message") or {}
-                text = msg.get("text") or ""
-                if not text.startswith("/"):
+                msg = upd.get("message")
+                text = msg and msg.get("text")
+                if not text or text[0] != "/":
                     continue
                 if not is_admin_user(upd):
                     continue
@@ -314,17 +531,8 @@ def poll_commands():
                 target, slot_hhmm = parsed
                 reply_chat = str(msg.get("chat", {}).get("id")) or ADMIN_CHAT_ID or CHAT_ID
 
-                if target == "usage":
-                    send_text(slot_hhmm, chat_id=reply_chat)
-                    continue
-
-                if target == "me":
-                    ok, summary = send_slot(slot_hhmm, target_chat=ADMIN_CHAT_ID or reply_chat)
-                    send_text(("✅ " if ok else "❌ ") + summary, chat_id=ADMIN_CHAT_ID or reply_chat)
-                else:
-                    ok, summary = send_slot(slot_hhmm, target_chat=None)
-                    if ADMIN_CHAT_ID:
-                        send_text(("✅ " if ok else "❌ ") + summary, chat_id=ADMIN_CHAT_ID)
+                # run on the scheduler's worker pool so sends never block the next getUpdates
+                scheduler.add_job(run_command, args=[target, slot_hhmm, reply_chat])
 
         except Exception as e:
             logging.warning("poll_commands loop error: %s", e)
@@ -332,20 +540,35 @@ def poll_commands():
 
 
 def main():
+    # the worker is stopped with SIGTERM; exit normally so atexit / finally flush state
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     load_state()
     cfg = fetch_config()
-    tzinfo = ZoneInfo(cfg.get("timezone", TZ))
-
-    scheduler = BackgroundScheduler(timezone=tzinfo)
-    for slot in ("11:00", "15:00", "22:00"):
-        hour, minute = slot.split(":")
-        trigger = CronTrigger(hour=int(hour), minute=int(minute), timezone=tzinfo)
+    tzinfo = _tz(cfg.get("timezone", TZ))
+
+    # small pool (slots + /test commands); a backed-up slot fires once, never overlapping itself
+    executors = {"default": ThreadPoolExecutor(max_workers=SCHEDULER_WORKERS)}
+    job_defaults = {"coalesce": True, "max_instances": 1, "misfire_grace_time": 300}
+    scheduler = BackgroundScheduler(timezone=tzinfo, executors=executors, job_defaults=job_defaults)
+    for slot in SLOTS:
+        trigger = slot_trigger(slot, cfg, tzinfo)
         scheduler.add_job(lambda s=slot: scheduled_job(s), trigger=trigger, id=f"slot_{slot}", replace_existing=True)
+    scheduler.add_job(
+        reschedule_slots,
+        trigger=CronTrigger(hour=0, minute=0, timezone=tzinfo),
+        args=[scheduler],
+        id="reschedule_slots",
+        replace_existing=True,
+    )
 
     scheduler.start()
     logging.info("Scheduler started. TZ=%s CHAT_ID=%s", cfg.get("timezone", TZ), CHAT_ID)
     self_check()
-    poll_commands()
+    try:
+        poll_commands(scheduler)
+    finally:
+        scheduler.shutdown(wait=False)
+        _flush_state_on_exit()
 
 
 if __name__ == "__main__":